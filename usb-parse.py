@@ -18,22 +18,28 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
-from dataclasses import dataclass, field
 from optparse import OptionParser
-import gzip
-import csv
+import threading
 import sys
 
+import numpy as np
+import pandas as pd
+from numba import njit
+
+@njit(cache=True)
 def usb_period(is_full_speed):
     if is_full_speed:
         return 1 / 12e6
     return 1 / 1.5e6
 
-crc5_tbl = [0x00, 0x0b, 0x16, 0x1d, 0x05, 0x0e, 0x13, 0x18, 0x0a, 0x01,
+# 5-bit values, so a plain uint8 table indexed at C level
+crc5_tbl = np.array(
+           [0x00, 0x0b, 0x16, 0x1d, 0x05, 0x0e, 0x13, 0x18, 0x0a, 0x01,
             0x1c, 0x17, 0x0f, 0x04, 0x19, 0x12, 0x14, 0x1f, 0x02, 0x09,
             0x11, 0x1a, 0x07, 0x0c, 0x1e, 0x15, 0x08, 0x03, 0x1b, 0x10,
-            0x0d, 0x06]
+            0x0d, 0x06], dtype=np.uint8)
 
+@njit(cache=True)
 def usb_crc5(data):
     data = data ^ 0x1f
     lsb = (data >> 1) & 0x1f
@@ -45,8 +51,17 @@ def usb_crc5(data):
 
     return crc ^ 0x1f
 
+@njit(cache=True)
+def usb_crc5_arr(tokens):
+    """Computes usb_crc5 for a whole array of 11-bit tokens at once."""
+    res = np.empty(tokens.shape[0], dtype=np.uint8)
+    for i in range(tokens.shape[0]):
+        res[i] = usb_crc5(tokens[i])
+    return res
+
 
-crc16_tbl = [0x0000, 0xc0c1, 0xc181, 0x0140, 0xc301, 0x03c0, 0x0280, 0xc241, 0xc601,
+crc16_tbl = np.array(
+            [0x0000, 0xc0c1, 0xc181, 0x0140, 0xc301, 0x03c0, 0x0280, 0xc241, 0xc601,
              0x06c0, 0x0780, 0xc741, 0x0500, 0xc5c1, 0xc481, 0x0440, 0xcc01, 0x0cc0,
              0x0d80, 0xcd41, 0x0f00, 0xcfc1, 0xce81, 0x0e40, 0x0a00, 0xcac1, 0xcb81,
              0x0b40, 0xc901, 0x09c0, 0x0880, 0xc841, 0xd801, 0x18c0, 0x1980, 0xd941,
@@ -74,37 +89,40 @@ crc16_tbl = [0x0000, 0xc0c1, 0xc181, 0x0140, 0xc301, 0x03c0, 0x0280, 0xc241, 0xc
              0x48c0, 0x4980, 0x8941, 0x4b00, 0x8bc1, 0x8a81, 0x4a40, 0x4e00, 0x8ec1,
              0x8f81, 0x4f40, 0x8d01, 0x4dc0, 0x4c80, 0x8c41, 0x4400, 0x84c1, 0x8581,
              0x4540, 0x8701, 0x47c0, 0x4680, 0x8641, 0x8201, 0x42c0, 0x4380, 0x8341,
-             0x4100, 0x81c1, 0x8081, 0x4040]
-
+             0x4100, 0x81c1, 0x8081, 0x4040], dtype=np.uint16)
+
+# Slicing-by-8 extension of the table above: crc16_tbl8[k][b] is the
+# CRC of byte b followed by k zero bytes, which lets usb_crc16 fold
+# eight payload bytes per iteration instead of one
+crc16_tbl8 = np.empty((8, 256), dtype=np.uint16)
+crc16_tbl8[0] = crc16_tbl
+for k in range(1, 8):
+    crc16_tbl8[k] = (crc16_tbl8[k - 1] >> 8) ^ \
+                    crc16_tbl[crc16_tbl8[k - 1] & 0xff]
+
+@njit(cache=True)
 def usb_crc16(data):
     crc = 0xffff
 
-    for b in data:
-        crc = (crc >> 8) ^ crc16_tbl[(crc ^ b) & 0xff]
+    n = data.shape[0]
+    i = 0
+    while n - i >= 8:
+        crc ^= np.int64(data[i]) | (np.int64(data[i + 1]) << 8)
+        crc = np.int64(crc16_tbl8[7, crc & 0xff] ^
+                       crc16_tbl8[6, (crc >> 8) & 0xff] ^
+                       crc16_tbl8[5, data[i + 2]] ^
+                       crc16_tbl8[4, data[i + 3]] ^
+                       crc16_tbl8[3, data[i + 4]] ^
+                       crc16_tbl8[2, data[i + 5]] ^
+                       crc16_tbl8[1, data[i + 6]] ^
+                       crc16_tbl8[0, data[i + 7]])
+        i += 8
+    while i < n:
+        crc = (crc >> 8) ^ crc16_tbl[(crc ^ data[i]) & 0xff]
+        i += 1
 
     return crc ^ 0xffff
 
-@dataclass
-class dpdm_sample:
-    dp:      int = 0
-    dm:      int = 0
-    next_tm: float = 0
-
-    def __init__(self, next_tm):
-        self.next_tm = next_tm
-
-class dpdm_byte:
-    nr_bits:  int = 0
-    b:        int = 0
-
-@dataclass
-class dpdm_pkt:
-    byte:      dpdm_byte = field(default_factory=dpdm_byte)
-    prev_bit:  int = None
-    nr_ones:   int = 0
-    discard:   bool = False
-    bytes_arr: list[int] = field(default_factory=list)
-
 usage = "Usage: %prog [OPTIONS] FILE"
 parser = OptionParser(usage=usage,
                       description="Reads CSV file (can be gzipped) with USB protocol extracted from oscilloscope by the `ds1054z` tool")
@@ -118,13 +136,6 @@ if len(args) == 0:
 else:
     filename = args[0]
 
-if filename.endswith('.gz'):
-    f_input = gzip.open(filename, 'rt')
-else:
-    f_input = open(filename)
-csv_input = csv.reader(f_input, skipinitialspace=True)
-header = next(csv_input)
-
 FS_SYNC   = 0x2a
 LS_SYNC   = 0xd5
 
@@ -139,9 +150,6 @@ PID_NAK   = 0x5a
 PID_STALL = 0x1e
 PID_PRE   = 0x3c
 
-LOW  = -1
-HIGH =  1
-
 UNKNOWN      = 0
 IDLE         = 1
 DETECT_SYNC  = 2
@@ -149,195 +157,460 @@ RECEIVE      = 3
 GOT_SE1      = 4
 GOT_EOP      = 5
 
-state = UNKNOWN
-se0_cnt = 0
+# Decoder event types
+EV_PKT   = 0
+EV_SE1   = 1
+EV_STUFF = 2
+
+def make_usb_decode(full_speed):
+    """Builds a decode kernel specialized for one bus speed.
+
+    The per-speed values (bit period, idle J polarity, expected SYNC
+    byte) are closure constants, so Numba folds them at compile time
+    and the speed checks vanish from the per-bit path. Two kernels are
+    built below, one per speed, and the caller dispatches once.
+    """
+    period = usb_period(full_speed)
+
+    # Idle J polarity as a bus value: D+ high for full speed, D- high
+    # for low speed
+    j_val = 1 if full_speed else 2
+    sync_val = FS_SYNC if full_speed else LS_SYNC
+
+    @njit(cache=True, nogil=True)
+    def usb_decode(tm, sig, edges, start, se0_init, carry_tail,
+                   ev_kind, ev_tm, ev_off, ev_len, pkt_pool):
+        """Decodes USB packets from the packed D+/D- signal array.
+
+        `sig` holds two bits per sample (bit 0: D+ high, bit 1: D-
+        high), `edges` lists the indices where `sig` changes value and
+        `start` is the sample index where the decoder enters IDLE.
+        Runs as a Numba nopython kernel, so all per-bit state lives in
+        scalar locals; the event arrays and the packet byte pool are
+        caller-owned scratch (at least `n` elements each), so one set
+        of buffers serves every block of a stream instead of being
+        reallocated per call. Fills the buffers with a chronological
+        list of events (decoded packets and warnings) for the caller
+        to report and returns the event count, the index from which
+        the samples were not consumed, and the SE0 run length to seed
+        the next call with (`se0_init`), since an SE0 run may span
+        packets.
+
+        With `carry_tail` set the input is one block of a longer
+        stream: a packet cut off by the end of the block is dropped
+        (including its events) and its samples are handed back, so the
+        caller can prepend them to the next block and decode the
+        packet whole.
+        """
+        n = tm.shape[0]
+
+        nr_events = 0
+        pool_off  = 0
 
-full_speed = None
-if options.speed == "low":
-    full_speed = False
-elif options.speed == "full":
-    full_speed = True
-
-period = None
-sample = None
-pkt = None
-prev_tm = None
-prev_dp = None
-prev_dm = None
-
-for v1, v2, v3 in csv_input:
-    tm_v = float(v1)
-    dp_v = float(v2)
-    dm_v = float(v3)
-
-    # To logical levels
-    dp_v = LOW if dp_v < 1.2 else HIGH
-    dm_v = LOW if dm_v < 1.2 else HIGH
-
-    # Detect full/low speed
-    if full_speed is None and dp_v != dm_v:
-        full_speed = (dp_v == HIGH)
-
-    # Detect required number of samples per USB period
-    if full_speed is not None and \
-       period is None and prev_tm is not None:
-        period = usb_period(full_speed)
         state = IDLE
-
-    # Detect SYNC
-    if state == IDLE and (prev_dp != dp_v or prev_dm != dm_v):
-        state = DETECT_SYNC
-        sample = dpdm_sample(tm_v + period)
-        pkt = dpdm_pkt()
-
-    # Oversampling and decoding
-    if sample is not None:
-        sample.dp  += dp_v
-        sample.dm  += dm_v
-
-        if tm_v >= sample.next_tm:
-            dp = 1 if sample.dp > 0 else 0
-            dm = 1 if sample.dm > 0 else 0
-
-            # Detect EOP or SE1
-            if dp != dm:
-                if se0_cnt >= 2:
+        se0_cnt = se0_init
+
+        # The capture grid is regular, so the next bit boundary is always
+        # at least `spb_min` samples away. Tracking the boundary as a
+        # sample index turns the per-sample check into an integer compare;
+        # the float `s_next_tm` accumulator is only touched once per bit.
+        dt = tm[1] - tm[0] if n > 1 else 0.0
+        spb_min = max(int(period / dt) - 2, 0) if dt > 0 else 0
+
+        tm_v = 0.0
+        nr_edges = edges.shape[0]
+
+        i = start
+        ep = 0
+        while i < n:
+            # IDLE: jump straight to the next line transition, which
+            # starts a SYNC. The bus idles between packets, so hopping
+            # along the edge list skips the idle stretches in O(1)
+            # instead of scanning them sample by sample.
+            if sig[i] == sig[i - 1]:
+                while ep < nr_edges and edges[ep] <= i:
+                    ep += 1
+                if ep == nr_edges:
+                    break
+                i = edges[ep]
+
+            # Start of a packet: from here on decode bit by bit, each bit
+            # being a majority vote over one USB period worth of samples
+            state = DETECT_SYNC
+            ev_base = nr_events
+            se0_base = se0_cnt
+            byte_b = 0
+            byte_nbits = 0
+            prev_bit = -1
+            nr_ones = 0
+            discard = False
+            pkt_off = pool_off
+            pkt_len = 0
+
+            s_next_tm = tm[i] + period
+            win = i
+            j = i + spb_min
+            while j < n and tm[j] < s_next_tm:
+                j += 1
+
+            while j < n:
+                # Boxcar accumulation over the whole bit window at once: a
+                # tight counted reduction LLVM can vectorize, instead of
+                # dribbling one sample into the window per outer iteration
+                s_dp = 0
+                s_dm = 0
+                for k in range(win, j + 1):
+                    s_dp += sig[k] & 1
+                    s_dm += sig[k] >> 1
+                s_cnt = j + 1 - win
+                tm_v = tm[j]
+
+                # Majority vote over the window
+                b_dp = 1 if 2 * s_dp > s_cnt else 0
+                b_dm = 1 if 2 * s_dm > s_cnt else 0
+
+                # Detect EOP or SE1 on the 2-bit bus value: SE0 is 0, SE1
+                # is 3, J/K are 1 and 2
+                bv = b_dp | (b_dm << 1)
+                is_se0 = 1 if bv == 0 else 0
+                is_se1 = 1 if bv == 3 else 0
+
+                if se0_cnt >= 2 and bv == j_val:
                     # EOP: detect J which follows the 2x SE0
-                    if full_speed and dp > dm:
-                        state = GOT_EOP
-                    elif not full_speed and dp < dm:
-                        state = GOT_EOP
-                se0_cnt = 0
-            elif dp == 0 and dm == 0:
-                se0_cnt += 1
-            else:
-                print("[%f] Warning: SE1 state detected" % tm_v)
-                state = GOT_SE1
-
-            # SE1 or EOP
-            if state == GOT_SE1 or state == GOT_EOP:
-                sample = None
-                if state == GOT_SE1:
-                    # Discard everything and start over
-                    pkt = None
-                    state = IDLE
-
-            # Do bit decoding only if not discarding the whole packet.
-            # In case of discard we wait for EOP or SE1 states and
-            # then start over.
-            elif not pkt.discard:
-                # Decode a bit
-                bit = raw_bit = 1 if dp > dm else 0
-                skip_stuffed_bit = False
-                if pkt.prev_bit is not None:
-                    # Decode NRZI
-                    bit = 1 if pkt.prev_bit == raw_bit else 0
-                    # Stuffed bit detection
-                    if bit == 1:
-                        pkt.nr_ones += 1
-                        if pkt.nr_ones == 7:
-                            print("[%f] Warning: stuffing error (7 \"ones\") detected" % tm_v)
-                            # 7.1.9.1: "If the receiver sees seven
-                            # consecutive ones anywhere in the packet,
-                            # then a bit stuffing error has occurred
-                            # and the packet should be ignored."
-                            pkt.discard = True
-                            continue
-                    else:
-                        if pkt.nr_ones == 6:
-                            skip_stuffed_bit = True
-                        pkt.nr_ones = 0
-                    pkt.prev_bit = raw_bit
-                if not skip_stuffed_bit:
-                    # Accept bit only if it is not a stuffed bit
-                    pkt.byte.b |= (bit << pkt.byte.nr_bits)
-                    pkt.byte.nr_bits += 1
-                if pkt.byte.nr_bits == 8:
-                    # Last bit of SYNC for further NRZI decoding
-                    if state == DETECT_SYNC:
-                        pkt.prev_bit = raw_bit
-                        # 7.1.9 Bit Stuffing: "The data “one” that
-                        # ends the Sync Pattern is counted as the
-                        # first one in a sequence."
-                        pkt.nr_ones = 1
-                    pkt.bytes_arr.append(pkt.byte.b)
-                    pkt.byte = dpdm_byte()
-
-                next_tm = sample.next_tm + period
-                sample = dpdm_sample(next_tm)
-
-    # Detect SYNC
-    if state == DETECT_SYNC:
-        if len(pkt.bytes_arr) == 1:
-            sync = pkt.bytes_arr[0]
-            if full_speed and sync == FS_SYNC:
-                pkt.byte = dpdm_byte()
-                state = RECEIVE
-            elif not full_speed and sync == LS_SYNC:
-                pkt.byte = dpdm_byte()
-                state = RECEIVE
-            else:
-                # Incorrect sync so start over
-                state = IDLE
-                sample = None
-                pkt = None
-
-    # We have a full packet
-    if state == GOT_EOP:
-        if not pkt.discard and len(pkt.bytes_arr) > 1:
-            if pkt.bytes_arr[1] == PID_SOF:
-                nr_frame = ((pkt.bytes_arr[3] & 7) << 8) | pkt.bytes_arr[2]
-                crc = ((pkt.bytes_arr[3] >> 3) & 0x1f)
-                print("%f |   SOF | NRFRAME %d | CRC5 0x%02x (%s) | -> " %
-                      (tm_v, nr_frame, crc,
-                       "OK" if usb_crc5(nr_frame) == crc else "ERR"),
-                      end='')
-
-            elif pkt.bytes_arr[1] == PID_SETUP or \
-                 pkt.bytes_arr[1] == PID_IN or \
-                 pkt.bytes_arr[1] == PID_OUT:
-                pid = "SETUP" if pkt.bytes_arr[1] == PID_SETUP else \
-                     ("IN" if pkt.bytes_arr[1] == PID_IN else "OUT")
-                addrendp = ((pkt.bytes_arr[3] & 7) << 8) | pkt.bytes_arr[2]
-                addr = (pkt.bytes_arr[2] & 0x7f)
-                endp = ((pkt.bytes_arr[3] & 7) << 1) | ((pkt.bytes_arr[2] & 0x80) >> 7)
-                crc = ((pkt.bytes_arr[3] >> 3) & 0x1f)
-
-                print("%f | %5s | ADDR %d | ENDP %d | CRC5 0x%02x (%s) | -> " %
-                      (tm_v, pid, addr, endp, crc,
-                       "OK" if usb_crc5(addrendp) == crc else "ERR"),
-                      end='')
-
-            elif pkt.bytes_arr[1] == PID_DATA0 or \
-                 pkt.bytes_arr[1] == PID_DATA1:
-                datanum = 0 if pkt.bytes_arr[1] == PID_DATA0 else 1
-                crc = (pkt.bytes_arr[-1] << 8) | pkt.bytes_arr[-2]
-                data0or1 = " ".join(["%02x" % v for v in pkt.bytes_arr[2:-2]])
-
-                print("%f | DATA%d | %s | CRC16 0x%04x (%s) | -> " %
-                      (tm_v, datanum, data0or1, crc,
-                       "OK" if usb_crc16(pkt.bytes_arr[2:-2]) == crc else "ERR"),
-                      end='')
-
-            elif pkt.bytes_arr[1] == PID_ACK:
-                print("%f |   ACK | -> " % (tm_v), end='')
-
-            elif pkt.bytes_arr[1] == PID_NAK:
-                print("%f |   NAK | -> " % (tm_v), end='')
-
-            elif pkt.bytes_arr[1] == PID_STALL:
-                print("%f | STALL | -> " % (tm_v), end='')
-
-            print("[", end='')
-            for i, b in enumerate(pkt.bytes_arr):
-                print("%02x%s" % (b, (' ' if i + 1 < len(pkt.bytes_arr) else '')),
-                      end='')
-            print(']')
-
-        state = IDLE
-        sample = None
-        pkt = None
+                    state = GOT_EOP
+                elif is_se1 == 1:
+                    ev_kind[nr_events] = EV_SE1
+                    ev_tm[nr_events] = tm_v
+                    nr_events += 1
+                    state = GOT_SE1
+
+                # The SE0 run grows on SE0, survives SE1 and resets on a
+                # differential state -- integer ops only, no branches
+                se0_cnt = (se0_cnt + is_se0) * (is_se0 | is_se1)
+
+                # SE1 or EOP
+                if state == GOT_SE1 or state == GOT_EOP:
+                    break
+
+                # Do bit decoding only if not discarding the whole packet.
+                # In case of discard we keep taking bit windows until EOP
+                # or SE1 and then start over.
+                if not discard:
+                    # Decode a bit
+                    bit = raw_bit = 1 if b_dp > b_dm else 0
+                    skip_stuffed_bit = False
+                    if prev_bit >= 0:
+                        # Decode NRZI: no transition means "one", so the
+                        # bit is just the inverted XOR of adjacent raw bits
+                        bit = (prev_bit ^ raw_bit) ^ 1
+                        # Stuffed bit detection
+                        if bit == 1:
+                            nr_ones += 1
+                            if nr_ones == 7:
+                                ev_kind[nr_events] = EV_STUFF
+                                ev_tm[nr_events] = tm_v
+                                nr_events += 1
+                                # 7.1.9.1: "If the receiver sees seven
+                                # consecutive ones anywhere in the packet,
+                                # then a bit stuffing error has occurred
+                                # and the packet should be ignored."
+                                discard = True
+                        else:
+                            if nr_ones == 6:
+                                skip_stuffed_bit = True
+                            nr_ones = 0
+                        prev_bit = raw_bit
+                if not discard:
+                    if not skip_stuffed_bit:
+                        # Accept bit only if it is not a stuffed bit
+                        byte_b |= (bit << byte_nbits)
+                        byte_nbits += 1
+                    if byte_nbits == 8:
+                        # Last bit of SYNC for further NRZI decoding
+                        if state == DETECT_SYNC:
+                            prev_bit = raw_bit
+                            # 7.1.9 Bit Stuffing: "The data “one” that
+                            # ends the Sync Pattern is counted as the
+                            # first one in a sequence."
+                            nr_ones = 1
+                        pkt_pool[pkt_off + pkt_len] = byte_b
+                        pkt_len += 1
+                        byte_b = 0
+                        byte_nbits = 0
+
+                        # Validate SYNC as soon as the first byte is in
+                        if state == DETECT_SYNC:
+                            if pkt_pool[pkt_off] == sync_val:
+                                state = RECEIVE
+                            else:
+                                # Incorrect sync so start over
+                                state = IDLE
+                                break
+
+                # Next bit window
+                win = j + 1
+                s_next_tm += period
+                j += spb_min
+                while j < n and tm[j] < s_next_tm:
+                    j += 1
+
+            # Ran out of samples mid-packet: in chunked mode forget
+            # this packet's events and hand its samples back, the next
+            # call re-decodes it from the SYNC transition
+            if carry_tail and (state == DETECT_SYNC or state == RECEIVE):
+                return ev_base, i - 1, se0_base
+
+            # We have a full packet. On SE1, incorrect SYNC or end of
+            # capture everything is discarded and scanning starts over.
+            if state == GOT_EOP and not discard and pkt_len > 1:
+                ev_kind[nr_events] = EV_PKT
+                ev_tm[nr_events] = tm_v
+                ev_off[nr_events] = pkt_off
+                ev_len[nr_events] = pkt_len
+                nr_events += 1
+                pool_off += pkt_len
+
+            state = IDLE
+            i = j + 1
+
+        return nr_events, n - 1, se0_cnt
+
+    return usb_decode
+
+usb_decode_fs = make_usb_decode(True)
+usb_decode_ls = make_usb_decode(False)
+
+def usb_report(nr_events, ev_kind, ev_tm, ev_off, ev_len, pkt_pool,
+               EV_PKT=EV_PKT, EV_SE1=EV_SE1, EV_STUFF=EV_STUFF,
+               PID_SOF=PID_SOF, PID_SETUP=PID_SETUP, PID_IN=PID_IN,
+               PID_OUT=PID_OUT, PID_DATA0=PID_DATA0,
+               PID_DATA1=PID_DATA1, PID_ACK=PID_ACK, PID_NAK=PID_NAK,
+               PID_STALL=PID_STALL,
+               usb_crc5_arr=usb_crc5_arr, usb_crc16=usb_crc16):
+    """Formats all decoded events and writes the report to stdout.
+
+    The constants and helpers are bound as default arguments, so the
+    per-event loop resolves them as LOAD_FAST locals instead of going
+    through a global dict lookup each time.
+    """
+    # All 11-bit CRC5 tokens (SOF frame numbers and ADDR/ENDP pairs) are
+    # gathered up front and checked with one vectorized call instead of a
+    # usb_crc5 round-trip per packet
+    tokens = []
+    for e in range(nr_events):
+        if ev_kind[e] != EV_PKT:
+            continue
+        off = ev_off[e]
+        pid = pkt_pool[off + 1]
+        if pid == PID_SOF or pid == PID_SETUP or \
+           pid == PID_IN or pid == PID_OUT:
+            tokens.append(((int(pkt_pool[off + 3]) & 7) << 8) |
+                          int(pkt_pool[off + 2]))
+    crc5_arr = usb_crc5_arr(np.array(tokens, dtype=np.uint16))
+    tok_i = 0
+
+    # Collect all report lines and write them out in one go at the end:
+    # one bulk write instead of a stdout round-trip per event
+    lines = []
+
+    for e in range(nr_events):
+        tm_v = ev_tm[e]
+
+        if ev_kind[e] == EV_SE1:
+            lines.append("[%f] Warning: SE1 state detected\n" % tm_v)
+            continue
+
+        if ev_kind[e] == EV_STUFF:
+            lines.append("[%f] Warning: stuffing error (7 \"ones\") detected\n" % tm_v)
+            continue
+
+        pkt = pkt_pool[ev_off[e]:ev_off[e] + ev_len[e]]
+        # One flat byte buffer instead of a list of boxed ints
+        bytes_arr = pkt.tobytes()
+
+        # Build the whole report line and write it out in one call: a
+        # per-byte print(..., end='') chain costs a stdout round-trip each
+        line = ""
+
+        if bytes_arr[1] == PID_SOF:
+            nr_frame = ((bytes_arr[3] & 7) << 8) | bytes_arr[2]
+            crc = ((bytes_arr[3] >> 3) & 0x1f)
+            line = "%f |   SOF | NRFRAME %d | CRC5 0x%02x (%s) | -> " % \
+                   (tm_v, nr_frame, crc,
+                    "OK" if crc5_arr[tok_i] == crc else "ERR")
+            tok_i += 1
+
+        elif bytes_arr[1] == PID_SETUP or \
+             bytes_arr[1] == PID_IN or \
+             bytes_arr[1] == PID_OUT:
+            pid = "SETUP" if bytes_arr[1] == PID_SETUP else \
+                 ("IN" if bytes_arr[1] == PID_IN else "OUT")
+            addrendp = ((bytes_arr[3] & 7) << 8) | bytes_arr[2]
+            addr = (bytes_arr[2] & 0x7f)
+            endp = ((bytes_arr[3] & 7) << 1) | ((bytes_arr[2] & 0x80) >> 7)
+            crc = ((bytes_arr[3] >> 3) & 0x1f)
+
+            line = "%f | %5s | ADDR %d | ENDP %d | CRC5 0x%02x (%s) | -> " % \
+                   (tm_v, pid, addr, endp, crc,
+                    "OK" if crc5_arr[tok_i] == crc else "ERR")
+            tok_i += 1
+
+        elif bytes_arr[1] == PID_DATA0 or \
+             bytes_arr[1] == PID_DATA1:
+            datanum = 0 if bytes_arr[1] == PID_DATA0 else 1
+            crc = (bytes_arr[-1] << 8) | bytes_arr[-2]
+            data0or1 = " ".join(["%02x" % v for v in bytes_arr[2:-2]])
+
+            line = "%f | DATA%d | %s | CRC16 0x%04x (%s) | -> " % \
+                   (tm_v, datanum, data0or1, crc,
+                    "OK" if usb_crc16(pkt[2:-2]) == crc else "ERR")
+
+        elif bytes_arr[1] == PID_ACK:
+            line = "%f |   ACK | -> " % (tm_v)
+
+        elif bytes_arr[1] == PID_NAK:
+            line = "%f |   NAK | -> " % (tm_v)
+
+        elif bytes_arr[1] == PID_STALL:
+            line = "%f | STALL | -> " % (tm_v)
+
+        line += "[" + " ".join(["%02x" % b for b in bytes_arr]) + "]\n"
+        lines.append(line)
+
+    sys.stdout.write("".join(lines))
+
+# How many CSV rows to parse and decode at a time. Keeps memory flat
+# regardless of capture length.
+CHUNK_ROWS = 1 << 20
+
+def read_chunks(filename):
+    """Yields the capture as float64 blocks of CHUNK_ROWS rows.
+
+    The pandas C parser is much faster than np.loadtxt and memory-maps
+    plain files instead of going through buffered reads (gzipped
+    captures are decompressed transparently); the TIME,CHAN1,CHAN2
+    header row names the columns. Parsing the next block runs in a
+    helper thread, pipelined with decoding the current one: the decode
+    kernel drops the GIL (nogil), so the two genuinely overlap.
+    """
+    reader = pd.read_csv(filename, engine='c', dtype=np.float64,
+                         memory_map=not filename.endswith('.gz'),
+                         chunksize=CHUNK_ROWS)
+    box = []
+    err = []
+
+    def pull():
+        # An exception must reach the consumer, not die with the
+        # thread, so a parse failure still aborts the script
+        try:
+            for chunk in reader:
+                box.append(chunk.to_numpy())
+                break
+        except Exception as e:
+            err.append(e)
+
+    t = threading.Thread(target=pull)
+    t.start()
+    while True:
+        t.join()
+        if err:
+            raise err[0]
+        if not box:
+            return
+        samples = box.pop()
+        t = threading.Thread(target=pull)
+        t.start()
+        yield samples
+
+full_speed = -1
+if options.speed == "low":
+    full_speed = 0
+elif options.speed == "full":
+    full_speed = 1
+
+# Samples handed back by the decoder: the sample preceding the next
+# packet (so the chunk starts with a detectable transition), or a whole
+# packet cut off by the chunk boundary, re-fed in front of the next one
+tm_tail  = np.empty(0, dtype=np.float64)
+sig_tail = np.empty(0, dtype=np.uint8)
+se0_cnt  = 0
+
+# Decoder scratch, reused across blocks and regrown only if a block
+# (plus its carried tail) outgrows it
+buf_len  = 0
+
+for samples in read_chunks(filename):
+    tm = samples[:, 0]
+
+    # To logical levels, packed into one uint8 per sample: bit 0 is D+
+    # high, bit 1 is D- high. Two bits per sample instead of two int8
+    # arrays halves the bytes the decode loop has to move; SE0 is
+    # sig == 0, SE1 is sig == 3, J/K are sig == 1 / sig == 2.
+    sig = (samples[:, 1] >= 1.2).view(np.uint8) | \
+          ((samples[:, 2] >= 1.2).view(np.uint8) << 1)
+
+    if tm_tail.shape[0]:
+        tm = np.concatenate((tm_tail, tm))
+        sig = np.concatenate((sig_tail, sig))
+
+    # A header-only capture makes pandas yield one empty chunk:
+    # nothing to detect or decode in it
+    if sig.shape[0] == 0:
+        continue
+
+    # Line transitions, found in one vectorized pass: the decoder hops
+    # along these instead of scanning idle samples one by one
+    edges = np.flatnonzero(sig[1:] != sig[:-1]) + 1
+
+    # Detect full/low speed by the first differential sample. The
+    # decoder enters IDLE where the original per-sample detection
+    # would have: at the detected sample, but never before the second
+    # one.
+    start = 1
+    if full_speed < 0:
+        diff = (sig == 1) | (sig == 2)
+        start = int(np.argmax(diff))
+        if not diff[start]:
+            # No differential sample yet, try the next chunk
+            tm_tail = tm[-1:].copy()
+            sig_tail = sig[-1:].copy()
+            continue
+        full_speed = int(sig[start] & 1)
+        start = max(start, 1)
+
+    # A lone carried sample next to an empty block is too short to
+    # decode (and would reach usb_decode with the scratch buffers
+    # never allocated); keep it for the next block
+    if tm.shape[0] < 2:
+        tm_tail = tm
+        sig_tail = sig
+        continue
+
+    if buf_len < tm.shape[0]:
+        buf_len  = tm.shape[0]
+        ev_kind  = np.empty(buf_len, dtype=np.int8)
+        ev_tm    = np.empty(buf_len, dtype=np.float64)
+        ev_off   = np.empty(buf_len, dtype=np.int64)
+        ev_len   = np.empty(buf_len, dtype=np.int64)
+        pkt_pool = np.empty(buf_len, dtype=np.uint8)
+
+    usb_decode = usb_decode_fs if full_speed == 1 else usb_decode_ls
+    nr_events, tail_start, se0_cnt = \
+        usb_decode(tm, sig, edges, start, se0_cnt, True,
+                   ev_kind, ev_tm, ev_off, ev_len, pkt_pool)
+    usb_report(nr_events, ev_kind, ev_tm, ev_off, ev_len, pkt_pool)
+
+    tm_tail = tm[tail_start:].copy()
+    sig_tail = sig[tail_start:].copy()
+
+# A packet cut off by the end of the capture was handed back whole:
+# decode it without the carry, so a truncated capture produces the
+# same warnings a single-shot decode would.
+if full_speed >= 0 and tm_tail.shape[0] > 1:
+    usb_decode = usb_decode_fs if full_speed == 1 else usb_decode_ls
+    edges = np.flatnonzero(sig_tail[1:] != sig_tail[:-1]) + 1
+    nr_events, tail_start, se0_cnt = \
+        usb_decode(tm_tail, sig_tail, edges, 1, se0_cnt, False,
+                   ev_kind, ev_tm, ev_off, ev_len, pkt_pool)
+    usb_report(nr_events, ev_kind, ev_tm, ev_off, ev_len, pkt_pool)
 
-    prev_tm = tm_v
-    prev_dp = dp_v
-    prev_dm = dm_v